@@ -1,9 +1,17 @@
 import os
-import json
 import time
+import hashlib
+import atexit
+import threading
+import itertools
+import orjson
 import requests
-from flask import Flask, Response
-from typing import Dict, Any, List
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, stream_with_context
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
 # ========= Env vars =========
 NOTION_TOKEN        = os.environ["NOTION_TOKEN"]
@@ -14,44 +22,65 @@ PROP_NETWORK_NAME   = os.environ.get("NOTION_PROP_NETWORK_NAME", "Network Name")
 PROP_POLYGON        = os.environ.get("NOTION_PROP_POLYGON", "Polygon")
 PROP_LEADERS        = os.environ.get("NOTION_PROP_LEADERS", "Network Leaders Names")
 
-NOTION_API = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
+# Seconds to reuse the built GeoJSON before querying Notion again (0 disables)
+CACHE_TTL           = float(os.environ.get("CACHE_TTL", "300"))
+
+# Parsed polygons kept across requests (LRU), optionally persisted as JSON on exit
+GEOM_CACHE_SIZE     = int(os.environ.get("GEOM_CACHE_SIZE", "5000"))
+GEOM_CACHE_PATH     = os.environ.get("GEOM_CACHE_PATH", "")
+
+NOTION_DB_API = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}"
+NOTION_API = f"{NOTION_DB_API}/query"
 HEADERS = {
     "Authorization": f"Bearer {NOTION_TOKEN}",
     "Notion-Version": "2022-06-28",
     "Content-Type": "application/json",
 }
 
+# Keep-alive session shared by all Notion calls. Retries back off on 429/5xx
+# and honor Notion's Retry-After header. Accept-Encoding is left to requests:
+# gzip/deflate, plus br when brotli is installed (it is in requirements.txt).
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=["GET", "POST"],
+        raise_on_status=False,
+    ),
+    pool_connections=4,
+    pool_maxsize=8,
+))
+
 # ========= Helpers: generic text extraction =========
+def _plain_from_rich_or_title_nostrip(prop: Dict[str, Any]) -> str:
+    key = prop.get("type")
+    if key != "rich_text" and key != "title":
+        return ""
+    return "".join([r.get("plain_text", "") for r in prop.get(key, ())])
+
 def _plain_from_rich_or_title(prop: Dict[str, Any]) -> str:
-    if "rich_text" in prop:
-        return "".join([r.get("plain_text", "") for r in prop.get("rich_text", [])]).strip()
-    if "title" in prop:
-        return "".join([r.get("plain_text", "") for r in prop.get("title", [])]).strip()
-    return ""
+    return _plain_from_rich_or_title_nostrip(prop).strip()
 
 def _plain_from_select(prop: Dict[str, Any]) -> str:
     sel = prop.get("select")
     return sel["name"] if sel else ""
 
 def _plain_from_multi_select(prop: Dict[str, Any]) -> str:
-    arr = prop.get("multi_select", [])
-    return ", ".join(opt.get("name", "") for opt in arr if opt.get("name"))
+    return ", ".join([n for opt in prop.get("multi_select", ()) if (n := opt.get("name"))])
 
 def _plain_from_people(prop: Dict[str, Any]) -> str:
-    arr = prop.get("people", [])
-    names = []
-    for u in arr:
-        # Notion "people" objects usually have 'name'; fallback to email.
-        names.append(u.get("name") or (u.get("person") or {}).get("email", ""))
+    # Notion "people" objects usually have 'name'; fallback to email.
+    names = [u.get("name") or (u.get("person") or {}).get("email", "") for u in prop.get("people", ())]
     return ", ".join([n for n in names if n])
 
 def _plain_from_rollup(prop: Dict[str, Any]) -> str:
     r = prop.get("rollup", {})
     t = r.get("type")
     if t == "array":
-        vals = []
-        for item in r.get("array", []):
-            vals.append(_read_text_flex(item))
+        vals = [_read_text_flex(item) for item in r.get("array", ())]
         return ", ".join([v for v in vals if v])
     if t == "number":
         return str(r.get("number", ""))
@@ -61,97 +90,313 @@ def _plain_from_rollup(prop: Dict[str, Any]) -> str:
     # fallback
     return ""
 
+# Notion property values name their payload key in "type"
+_EXTRACTORS = {
+    "select": _plain_from_select,
+    "multi_select": _plain_from_multi_select,
+    "people": _plain_from_people,
+    "rollup": _plain_from_rollup,
+    "rich_text": _plain_from_rich_or_title,
+    "title": _plain_from_rich_or_title,
+}
+
 def _read_text_flex(prop: Dict[str, Any]) -> str:
     """Return human-readable text from many Notion property types."""
-    if "select" in prop:
-        return _plain_from_select(prop)
-    if "multi_select" in prop:
-        return _plain_from_multi_select(prop)
-    if "people" in prop:
-        return _plain_from_people(prop)
-    if "rollup" in prop:
-        return _plain_from_rollup(prop)
-    # fallbacks: rich_text or title
-    return _plain_from_rich_or_title(prop)
+    extract = _EXTRACTORS.get(prop.get("type"))
+    return extract(prop) if extract else ""
 
 # ========= Polygon parsing =========
-def _read_polygon_geometry(prop: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Expect polygon JSON stored as text in a rich_text or title property.
-    Returns a GeoJSON geometry dict with 'type' and 'coordinates'.
-    """
-    raw = _plain_from_rich_or_title(prop)
+def _read_polygon_text(prop: Dict[str, Any]) -> str:
+    """Expect polygon JSON stored as text in a rich_text or title property."""
+    # Unstripped: _parse_polygon_geometry only trims when it has to, which
+    # avoids copying a potentially large polygon string in the common case.
+    return _plain_from_rich_or_title_nostrip(prop)
+
+def _parse_polygon_geometry(raw: str) -> Dict[str, Any]:
+    """Parse polygon text into a GeoJSON geometry dict with 'type' and 'coordinates'."""
+    # orjson only skips JSON whitespace; text pasted into Notion often carries
+    # Unicode spaces (e.g. U+00A0) around it, which str.strip() removes
+    if raw[:1].isspace() or raw[-1:].isspace():
+        raw = raw.strip()
     if not raw:
         raise ValueError("Polygon field is empty")
     try:
-        geom = json.loads(raw)
-    except json.JSONDecodeError as e:
+        geom = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
         raise ValueError(f"Polygon JSON parse error: {e}")
-    # Minimal validation
-    if not isinstance(geom, dict) or "type" not in geom or "coordinates" not in geom:
+    # Minimal validation; orjson only ever produces plain dicts for objects
+    if type(geom) is not dict or "type" not in geom or "coordinates" not in geom:
         raise ValueError("Polygon must be a GeoJSON geometry object with type/coordinates")
     return geom
 
+# ========= Geometry cache =========
+# Parsed geometries keyed by page id, least recently used first, each stored
+# with the polygon text it was parsed from. Notion's last_edited_time is only
+# minute-precise, so the text itself decides whether an entry is still valid;
+# comparing it is far cheaper than parsing it again.
+_GEOM_CACHE: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+_GEOM_LOCK = threading.Lock()
+
+def _page_geometry(page: Dict[str, Any], prop: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the page's polygon geometry, parsing it only if the polygon text changed."""
+    page_id = page.get("id", "")
+    raw = _read_polygon_text(prop)
+    with _GEOM_LOCK:
+        hit = _GEOM_CACHE.get(page_id)
+        if hit is not None and hit[0] == raw:
+            _GEOM_CACHE.move_to_end(page_id)
+            return hit[1]
+    geom = _parse_polygon_geometry(raw)
+    if GEOM_CACHE_SIZE > 0 and page_id:
+        with _GEOM_LOCK:
+            _GEOM_CACHE[page_id] = (raw, geom)
+            _GEOM_CACHE.move_to_end(page_id)
+            while len(_GEOM_CACHE) > GEOM_CACHE_SIZE:
+                _GEOM_CACHE.popitem(last=False)
+    return geom
+
+def _load_geom_cache() -> None:
+    if not GEOM_CACHE_PATH or GEOM_CACHE_SIZE <= 0 or not os.path.exists(GEOM_CACHE_PATH):
+        return
+    try:
+        with open(GEOM_CACHE_PATH, "rb") as f:
+            rows = orjson.loads(f.read())
+        for page_id, raw, geom in rows[-GEOM_CACHE_SIZE:]:
+            _GEOM_CACHE[page_id] = (raw, geom)
+    except (OSError, ValueError, TypeError) as err:
+        print(f"⚠️ Ignoring geometry cache {GEOM_CACHE_PATH}: {err}")
+
+def _save_geom_cache() -> None:
+    if not GEOM_CACHE_PATH:
+        return
+    with _GEOM_LOCK:
+        rows = [[page_id, raw, geom] for page_id, (raw, geom) in _GEOM_CACHE.items()]
+    tmp = f"{GEOM_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(rows))
+        os.replace(tmp, GEOM_CACHE_PATH)
+    except OSError as err:
+        print(f"⚠️ Could not write geometry cache {GEOM_CACHE_PATH}: {err}")
+
+_load_geom_cache()
+atexit.register(_save_geom_cache)
+
 # ========= Notion fetch =========
-def fetch_all_pages() -> List[Dict[str, Any]]:
-    """Query the Notion DB with pagination; respect rate limits (3 req/sec)."""
-    pages = []
-    payload: Dict[str, Any] = {"page_size": 100}
-    while True:
-        resp = requests.post(NOTION_API, headers=HEADERS, json=payload, timeout=30)
-        if resp.status_code == 429:
-            time.sleep(1)
-            continue
+# Shared pacing for all Notion calls in this process (monotonic clock)
+# Notion documents ~3 req/sec but throttles bursts; 2 req/sec stays clear of 429s
+MIN_REQUEST_INTERVAL = float(os.environ.get("NOTION_MIN_REQUEST_INTERVAL", "0.5"))
+_RATE_LOCK = threading.Lock()
+_next_request_at = 0.0
+
+def _throttle() -> None:
+    """Block until the next Notion request slot; slots are MIN_REQUEST_INTERVAL apart."""
+    global _next_request_at
+    with _RATE_LOCK:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(_next_request_at, now) + MIN_REQUEST_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+
+# IDs of the properties we read, resolved from the DB schema on first use and
+# kept for the life of the process. Property IDs survive renames, so they are
+# only looked up again while a configured name is missing from the schema, at
+# most every PROP_IDS_RETRY seconds.
+PROP_IDS_RETRY = 300.0
+_PROP_IDS: Optional[List[str]] = None
+_PROP_IDS_RETRY_AT = 0.0
+
+def _prop_ids() -> List[str]:
+    """Map our property names to Notion property IDs (used for filter_properties)."""
+    global _PROP_IDS, _PROP_IDS_RETRY_AT
+    if _PROP_IDS is not None and time.monotonic() < _PROP_IDS_RETRY_AT:
+        return _PROP_IDS
+    # Same lock as cache rebuilds, so concurrent callers share one lookup
+    with _REBUILD_LOCK:
+        if _PROP_IDS is not None and time.monotonic() < _PROP_IDS_RETRY_AT:
+            return _PROP_IDS
+        _throttle()
+        resp = SESSION.get(NOTION_DB_API, timeout=30)
         resp.raise_for_status()
-        data = resp.json()
-        pages.extend(data.get("results", []))
-        if data.get("has_more"):
-            payload["start_cursor"] = data["next_cursor"]
-            time.sleep(0.35)  # be polite to Notion
-        else:
-            break
-    return pages
+        schema = orjson.loads(resp.content).get("properties", {})
+        ids = []
+        missing = False
+        for name in (PROP_NETWORK_NAME, PROP_POLYGON, PROP_LEADERS):
+            if name in schema:
+                ids.append(schema[name]["id"])
+            else:
+                missing = True
+                print(f"⚠️ Property '{name}' not found in database schema; its values will be empty")
+        _PROP_IDS = ids
+        _PROP_IDS_RETRY_AT = time.monotonic() + PROP_IDS_RETRY if missing else float("inf")
+    return _PROP_IDS
+
+def _query(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    _throttle()
+    resp = SESSION.post(url, json=payload, timeout=30)
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+def iter_pages() -> Iterator[Dict[str, Any]]:
+    """
+    Query the Notion DB with pagination, yielding pages as each batch arrives.
+    The next batch is requested in the background while the current one is
+    consumed; see _throttle for rate limiting.
+    """
+    # Only ask for the properties we read; results are still keyed by name.
+    # Property IDs come back from Notion already URL-encoded.
+    url = NOTION_API
+    ids = _prop_ids()
+    if ids:
+        url += "?" + "&".join(f"filter_properties={pid}" for pid in ids)
+    pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        pending: Optional[Future] = pool.submit(_query, url, {"page_size": 100})
+        while pending is not None:
+            data = pending.result()
+            pending = None
+            if data.get("has_more"):
+                pending = pool.submit(_query, url, {"page_size": 100, "start_cursor": data["next_cursor"]})
+            yield from data.get("results", [])
+    finally:
+        # Don't hold up a disconnected client on a prefetch nobody will read
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _started(pages: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Pull the first page now so the schema lookup and first query run before a
+    streamed response sends its status line; upstream errors then become a 5xx
+    instead of a truncated 200. Later batches still stream.
+    """
+    first = next(pages, None)
+    if first is None:
+        return pages
+    return itertools.chain((first,), pages)
 
 # ========= GeoJSON build =========
-def build_geojson(pages: List[Dict[str, Any]]) -> Dict[str, Any]:
-    features = []
+def iter_features(pages: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Yield one GeoJSON Feature per page; pages without a usable polygon are skipped."""
+    # Hot loop: bind globals to locals once instead of looking them up per page
+    read_text, page_geometry = _read_text_flex, _page_geometry
+    prop_polygon, prop_name, prop_leaders = PROP_POLYGON, PROP_NETWORK_NAME, PROP_LEADERS
     for p in pages:
         props = p.get("properties", {})
         try:
-            if PROP_POLYGON not in props:
-                raise KeyError(f"Missing '{PROP_POLYGON}' property")
-
-            geom = _read_polygon_geometry(props[PROP_POLYGON])
-
-            network_name = _read_text_flex(props.get(PROP_NETWORK_NAME, {})) if PROP_NETWORK_NAME in props else ""
-            leaders      = _read_text_flex(props.get(PROP_LEADERS, {})) if PROP_LEADERS in props else ""
-
-            features.append({
-                "type": "Feature",
-                "geometry": geom,
-                "properties": {
-                    "Network": network_name,
-                    "Leaders": leaders
-                }
-            })
+            poly = props.get(prop_polygon)
+            if poly is None:
+                raise KeyError(f"Missing '{prop_polygon}' property")
+
+            geom = page_geometry(p, poly)
+
+            name_prop    = props.get(prop_name)
+            leaders_prop = props.get(prop_leaders)
+            network_name = read_text(name_prop) if name_prop else ""
+            leaders      = read_text(leaders_prop) if leaders_prop else ""
         except Exception as err:
             print(f"⚠️ Skipping page {p.get('id','?')}: {err}")
             continue
 
-    return {"type": "FeatureCollection", "features": features}
+        yield {
+            "type": "Feature",
+            "geometry": geom,
+            "properties": {
+                "Network": network_name,
+                "Leaders": leaders
+            }
+        }
+
+# ========= Response cache =========
+# Serialized FeatureCollection per database, reused until its expiry (monotonic).
+# The body is kept as a list of chunks: WSGI writes them in order, so the full
+# payload is never joined into one buffer.
+# Only one rebuild runs at a time: requests that miss while another request is
+# rebuilding wait on _REBUILD_LOCK, then serve the entry it stored instead of
+# paginating Notion again. Reentrant so Notion helpers can take it too.
+_CACHE: Dict[str, Dict[str, Any]] = {}
+_REBUILD_LOCK = threading.RLock()
+
+def _cached_entry() -> Optional[Dict[str, Any]]:
+    entry = _CACHE.get(NOTION_DATABASE_ID)
+    if entry and time.monotonic() < entry["exp"]:
+        return entry
+    return None
+
+def _store_body(body: List[bytes], etag: str) -> Dict[str, Any]:
+    entry = {"exp": time.monotonic() + CACHE_TTL, "body": body, "etag": etag}
+    if CACHE_TTL > 0:
+        _CACHE[NOTION_DATABASE_ID] = entry
+    return entry
+
+def _build_body(pages: Iterable[Dict[str, Any]]) -> List[bytes]:
+    """Serialize the FeatureCollection as a list of chunks: envelope, one per feature."""
+    chunks = [b'{"type":"FeatureCollection","features":[']
+    sep = b""
+    for feat in iter_features(pages):
+        chunks.append(sep + orjson.dumps(feat))
+        sep = b","
+    chunks.append(b"]}")
+    return chunks
+
+def _body_etag(chunks: List[bytes]) -> str:
+    # orjson output is deterministic, so an unchanged DB rebuilds to the same
+    # ETag and clients revalidating after the cache expired still get a 304
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
 
 # ========= Flask app =========
 app = Flask(__name__)
 
+def _geojson_response(body: Iterable[bytes], cache_status: str) -> Response:
+    resp = Response(
+        body,
+        mimetype="application/geo+json",
+        headers={
+            "Content-Disposition": 'inline; filename="Notion-Networks.geojson"',
+            "X-Cache": cache_status,
+        }
+    )
+    # Clients may store the body but must revalidate it; see serve_geojson
+    resp.cache_control.public = True
+    resp.cache_control.no_cache = True
+    return resp
+
 @app.route("/")
 def serve_geojson():
-    pages = fetch_all_pages()
-    fc = build_geojson(pages)
+    entry = _cached_entry()
+    cache_status = "HIT"
+    if entry is None:
+        with _REBUILD_LOCK:
+            # Another request may have rebuilt the body while we waited
+            entry = _cached_entry()
+            if entry is None:
+                # The body is built in full before answering so that every 200
+                # carries its ETag and Notion errors still produce a 5xx. For
+                # incremental output use /features.geojsonl.
+                body = _build_body(iter_pages())
+                entry = _store_body(body, _body_etag(body))
+                cache_status = "MISS"
+    # Revalidating clients get a bodiless 304 when the body is unchanged
+    resp = _geojson_response(entry["body"], cache_status)
+    resp.set_etag(entry["etag"])
+    return resp.make_conditional(request)
+
+@app.route("/features.geojsonl")
+def serve_geojsonl():
+    """Newline-delimited features, streamed straight from Notion (not cached)."""
+    pages = _started(iter_pages())
+
+    def gen() -> Iterator[bytes]:
+        for feat in iter_features(pages):
+            yield orjson.dumps(feat, option=orjson.OPT_APPEND_NEWLINE)
+
     return Response(
-        json.dumps(fc),
-        mimetype="application/geo+json",
+        stream_with_context(gen()),
+        mimetype="application/x-ndjson",
         headers={
-            "Content-Disposition": 'inline; filename="Notion-Networks.geojson"'
+            "Content-Disposition": 'inline; filename="Notion-Networks.geojsonl"'
         }
     )
 
@@ -0,0 +1,11 @@
+import os
+
+# Picked up automatically when started as `gunicorn app:app` from this directory.
+# The app is almost entirely Notion/client I/O, so gevent workers overlap many
+# requests per process; gunicorn monkey-patches sockets before loading app.py.
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "100"))
+# The response cache and the Notion rate limiter are per process, so extra
+# workers mean extra Notion traffic; one gevent worker is usually enough.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))